@@ -4,7 +4,7 @@ import plotly.express as px
 import plotly.graph_objects as go
 import altair as alt
 from datetime import datetime, timedelta, timezone
-from gpu_data import GPUS, USERS, load_reservations, add_reservation, delete_reservations, get_occupancy_stats, check_conflicts
+from gpu_data import GPUS, USERS, load_reservations, add_reservation, delete_reservations, get_occupancy_stats, check_conflicts, query_reservations, get_sync_status, get_rollups, verify_rollups
 
 # --- Timezone Setup ---
 KST = timezone(timedelta(hours=9))
@@ -117,21 +117,12 @@ with tab1:
         
         dates_in_month = pd.date_range(start_of_month, next_month - timedelta(days=1))
         
+        # Per-day counts come from the daily rollups instead of rescanning reservations.
+        rollups = get_rollups()
+        
         cal_data = []
         for d in dates_in_month:
-            # Force naive pd.Timestamp for comparison with datetime64[ns]
-            day_start = pd.to_datetime(d).tz_localize(None)
-            day_end = day_start + pd.Timedelta(days=1)
-            
-            count = 0
-            users = []
-            if not df.empty:
-                matches = df[
-                    (pd.to_datetime(df['Start']).dt.tz_localize(None) < day_end) & 
-                    (pd.to_datetime(df['End']).dt.tz_localize(None) > day_start)
-                ]
-                count = len(matches)
-                users = matches['User'].unique().tolist()
+            count, users = rollups.day(d)
             
             # Week of month calculation
             first_day_weekday = start_of_month.weekday() # 0=Mon
@@ -322,6 +313,96 @@ with tab1:
     else:
         st.info("No reservations in system.")
 
+    st.divider()
+
+    # --- 3. Long-range Usage (read from hourly/daily rollups) ---
+    st.subheader("📈 Long-range Usage")
+    rollups = get_rollups()
+    this_year = get_today().year
+    trend_year = st.selectbox("Year", list(range(this_year, this_year - 5, -1)), key="trend_year")
+    year_start = pd.Timestamp(year=trend_year, month=1, day=1)
+    year_end = pd.Timestamp(year=trend_year + 1, month=1, day=1)
+    
+    daily_gpu = rollups.frame("daily_gpu", year_start, year_end)
+    if not daily_gpu.empty:
+        # Yearly heatmap: total reserved GPU-hours per day
+        days = pd.DataFrame({'Bucket': pd.date_range(year_start, year_end - timedelta(days=1))})
+        per_day = daily_gpu.groupby('Bucket', as_index=False)['Hours'].sum()
+        days = days.merge(per_day, on='Bucket', how='left').fillna({'Hours': 0.0})
+        days['Week'] = (days['Bucket'] - (year_start - pd.Timedelta(days=year_start.weekday()))).dt.days // 7
+        days['Weekday_Str'] = days['Bucket'].dt.strftime('%a')
+        
+        fig_year = go.Figure(data=go.Heatmap(
+            x=days['Week'],
+            y=days['Weekday_Str'],
+            z=days['Hours'],
+            customdata=days['Bucket'].dt.strftime('%Y-%m-%d'),
+            hovertemplate="<b>%{customdata}</b><br>GPU-hours: %{z:.1f}<extra></extra>",
+            colorscale=[[0, '#f0f2f6'], [1, '#e94560']],
+            showscale=False,
+            xgap=2,
+            ygap=2
+        ))
+        fig_year.update_layout(
+            xaxis=dict(visible=False, fixedrange=True),
+            yaxis=dict(
+                categoryorder='array', categoryarray=['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'],
+                autorange="reversed", fixedrange=True
+            ),
+            margin=dict(t=10, b=10, l=10, r=10),
+            height=220,
+            paper_bgcolor='rgba(0,0,0,0)',
+            plot_bgcolor='rgba(0,0,0,0)'
+        )
+        st.plotly_chart(fig_year, use_container_width=True)
+        
+        c_quarter, c_hour = st.columns(2)
+        with c_quarter:
+            # Per-user GPU-hours by quarter
+            daily_user = rollups.frame("daily_user", year_start, year_end)
+            daily_user['Quarter'] = "Q" + daily_user['Bucket'].dt.quarter.astype(str)
+            per_quarter = daily_user.groupby(['Quarter', 'Key'], as_index=False)['Hours'].sum()
+            fig_q = px.bar(
+                per_quarter, x='Quarter', y='Hours', color='Key',
+                labels={'Key': 'User', 'Hours': 'GPU-hours'},
+                category_orders={'Quarter': ['Q1', 'Q2', 'Q3', 'Q4']}
+            )
+            fig_q.update_layout(title_text="GPU-hours per user by quarter", height=400)
+            st.plotly_chart(fig_q, use_container_width=True)
+        
+        with c_hour:
+            # Average load by hour of day, per server
+            # Only days up to today, so future bookings can't push the average past 100%.
+            hours_end = min(year_end, pd.Timestamp(get_today()) + pd.Timedelta(days=1))
+            hourly_gpu = rollups.frame("hourly_gpu", year_start, hours_end)
+            if hourly_gpu.empty:
+                st.info("No reservations up to today in this year yet.")
+            else:
+                hourly_gpu['Hour'] = hourly_gpu['Bucket'].dt.hour
+                n_days = (hours_end - year_start).days
+                per_hour = hourly_gpu.groupby(['Hour', 'Key'], as_index=False)['Hours'].sum()
+                per_hour['Utilization'] = per_hour['Hours'] / max(n_days, 1) * 100
+                fig_h = px.line(
+                    per_hour.sort_values('Hour'), x='Hour', y='Utilization', color='Key',
+                    labels={'Key': 'Server', 'Utilization': 'Reserved (%)'}
+                )
+                fig_h.update_layout(title_text="Average reservation load by hour of day", height=400)
+                st.plotly_chart(fig_h, use_container_width=True)
+    else:
+        st.info(f"No reservations in {trend_year}.")
+    
+    with st.expander("🔍 Rollup consistency check"):
+        st.caption("Compares the incrementally maintained rollups with a full recomputation from all reservations.")
+        if st.button("Run check", key="rollup_check"):
+            mismatches = verify_rollups(rebuild=True)
+            if mismatches is None:
+                pass  # load error already reported
+            elif mismatches.empty:
+                st.success("Rollups match a full recomputation.")
+            else:
+                st.warning(f"{len(mismatches)} rollup cells differed; rollups were rebuilt.")
+                st.dataframe(mismatches.astype(str), hide_index=True, use_container_width=True)
+
 # ==========================
 # TAB 2: RESERVE
 # ==========================
@@ -372,7 +453,7 @@ with tab2:
                 conflicts = check_conflicts(gpu_id_to_book, start_dt, end_dt)
                 
             if not conflicts:
-                with st.spinner("Saving reservation to Google Sheets..."):
+                with st.spinner("Saving reservation..."):
                     success, msg = add_reservation(user, gpu_id_to_book, start_dt, end_dt, project)
                 if success:
                     st.success(msg)
@@ -463,44 +544,115 @@ with tab4:
     st.header("🛠️ Management & Reservation Cancellation")
     st.markdown("Select reservations to **Delete/Cancel**.")
     
-    df_manage = load_reservations()
-    if not df_manage.empty:
-        # Sort by latest
-        df_manage = df_manage.sort_values(by="Start", ascending=False).reset_index(drop=True)
-        
-        # Add Checkbox
-        df_manage['Select'] = False
-        
-        # We need to map back to original indices if we sorted, or just use the filtered logic carefully.
-        # Simpler approach: Display data_editor with full data, let user select.
-        # But if we sort, the index changes.
-        # Let's reload without sort for deletion safety, or include original ID if we had one.
-        # For V1: Just show raw dataframe (it's safe enough for small team).
-        
+    # Filters are applied in gpu_data.query_reservations; only the visible page is rendered.
+    f1, f2, f3, f4, f5 = st.columns([2, 2, 2, 1, 1])
+    with f1:
+        f_user = st.selectbox("User", ["All"] + USERS, key="mg_user")
+    with f2:
+        f_gpu = st.selectbox("GPU", ["All"] + [g['id'] for g in GPUS], key="mg_gpu")
+    with f3:
+        f_range = st.date_input("Date range", value=(), key="mg_range")
+    with f4:
+        f_upcoming = st.checkbox("Upcoming only", value=True, key="mg_upcoming")
+    with f5:
+        page_size = st.selectbox("Rows", [10, 25, 50, 100], index=1, key="mg_page_size")
+
+    date_from = f_range[0] if len(f_range) > 0 else None
+    date_to = f_range[1] if len(f_range) > 1 else date_from
+
+    # Reset paging whenever the filter set changes; keep selections (they are stable row IDs).
+    filter_key = (f_user, f_gpu, date_from, date_to, f_upcoming, page_size)
+    if st.session_state.get('mg_filter_key') != filter_key:
+        st.session_state.mg_filter_key = filter_key
+        st.session_state.mg_cursors = [None]
+    if 'mg_selected' not in st.session_state:
+        st.session_state.mg_selected = set()
+
+    page_no = len(st.session_state.mg_cursors) - 1
+    page_df, next_cursor, total = query_reservations(
+        user=None if f_user == "All" else f_user,
+        gpu_id=None if f_gpu == "All" else f_gpu,
+        date_from=date_from,
+        date_to=date_to,
+        upcoming_only=f_upcoming,
+        now=get_now().replace(tzinfo=None),
+        after=st.session_state.mg_cursors[-1],
+        page_size=page_size
+    )
+
+    if total > 0:
+        page_df = page_df.copy()
+        page_df['Select'] = page_df.index.isin(st.session_state.mg_selected)
+
         edited_df = st.data_editor(
-            df_manage, 
+            page_df,
             column_config={
                 "Select": st.column_config.CheckboxColumn("Delete?", default=False)
             },
-            hide_index=False,
+            disabled=[c for c in page_df.columns if c != 'Select'],
+            hide_index=True,
             use_container_width=True,
-            num_rows="fixed" 
+            num_rows="fixed",
+            key=f"mg_editor_{page_no}"
         )
-        
+
+        # Merge this page's checkboxes into the selection held across pages.
+        page_ids = set(edited_df.index)
+        checked = set(edited_df[edited_df['Select']].index)
+        st.session_state.mg_selected = (st.session_state.mg_selected - page_ids) | checked
+
+        n_pages = -(-total // page_size)
+        p_prev, p_info, p_next = st.columns([1, 2, 1])
+        with p_prev:
+            if st.button("◀ Previous", disabled=page_no == 0, key="mg_prev"):
+                st.session_state.mg_cursors.pop()
+                st.rerun()
+        with p_info:
+            st.caption(f"Page {page_no + 1} of {n_pages} · {total} matching reservations · {len(st.session_state.mg_selected)} selected")
+        with p_next:
+            if st.button("Next ▶", disabled=next_cursor is None, key="mg_next"):
+                st.session_state.mg_cursors.append(next_cursor)
+                st.rerun()
+
         if st.button("🗑️ Delete Selected Rows"):
-            # Identify rows where 'Select' is True
-            to_delete = edited_df[edited_df['Select']].index.tolist()
-            
-            if to_delete:
+            selected = st.session_state.mg_selected
+            # Re-read the sheet: IDs are row content, so only rows still exactly as shown resolve.
+            current = load_reservations()
+            to_delete = current.loc[current.index.intersection(sorted(selected))]
+            missing = len(selected) - len(to_delete)
+            if missing:
+                st.warning(f"{missing} selected reservations were changed or removed since they were shown and were skipped.")
+                st.session_state.mg_selected = set(to_delete.index)
+
+            if not to_delete.empty:
                 success, msg = delete_reservations(to_delete)
                 if success:
                     st.success(f"Deleted {len(to_delete)} reservations.")
+                    st.session_state.mg_selected = set()
+                    st.session_state.mg_cursors = [None]
                     st.cache_data.clear()
                     st.rerun()
                 else:
                     st.error(msg)
-            else:
+            elif not missing:
                 st.info("No rows selected.")
-            
+
     else:
         st.info("No reservations to manage.")
+
+    # Writes are acknowledged once journaled locally and synced to the sheet in the background.
+    pending_writes, sync_error = get_sync_status()
+    if pending_writes:
+        with st.expander(f"⏳ Pending sync to Google Sheets ({len(pending_writes)})"):
+            if sync_error:
+                st.warning(f"Last sync attempt failed, retrying: {sync_error}")
+            st.dataframe(
+                pd.DataFrame(
+                    [[e['op'].capitalize()] + e['row'] for e in pending_writes],
+                    columns=["Action", "User", "GPU_ID", "GPU_Type", "Start", "End", "Project"]
+                ),
+                hide_index=True,
+                use_container_width=True
+            )
+    else:
+        st.caption("✅ All changes are synced to Google Sheets.")
\ No newline at end of file
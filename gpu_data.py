@@ -1,9 +1,13 @@
 import pandas as pd
 import os
+import threading
+import time
 from datetime import datetime, timedelta
 import streamlit as st
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
+from write_journal import WriteJournal, FlushInProgress, normalize_row, find_row
+from rollups import OccupancyRollups, compare_rollups
 
 # --- Resource Definitions ---
 GPUS = [
@@ -15,6 +19,8 @@ GPUS = [
     {"id": "H100-02", "type": "H100"},
 ]
 
+COLUMNS = ["User", "GPU_ID", "GPU_Type", "Start", "End", "Project"]
+
 # --- User List ---
 USERS = [
     "Mincheol Kang (강민철)", "Jeonghyeon Noh (노정현)", "Nakgyu Yang (양낙규)",
@@ -25,24 +31,27 @@ USERS = [
 ]
 
 # Initialize GSpread Connection
+def _authorize():
+    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+    # Convert streamlit secrets to dict format expected by gspread
+    creds_dict = {
+        "type": st.secrets["connections"]["gsheets"]["type"],
+        "project_id": st.secrets["connections"]["gsheets"]["project_id"],
+        "private_key_id": st.secrets["connections"]["gsheets"]["private_key_id"],
+        "private_key": st.secrets["connections"]["gsheets"]["private_key"].replace("\\n", "\n"),
+        "client_email": st.secrets["connections"]["gsheets"]["client_email"],
+        "client_id": st.secrets["connections"]["gsheets"]["client_id"],
+        "auth_uri": st.secrets["connections"]["gsheets"]["auth_uri"],
+        "token_uri": st.secrets["connections"]["gsheets"]["token_uri"],
+        "auth_provider_x509_cert_url": st.secrets["connections"]["gsheets"]["auth_provider_x509_cert_url"],
+        "client_x509_cert_url": st.secrets["connections"]["gsheets"]["client_x509_cert_url"]
+    }
+    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
+    return gspread.authorize(creds)
+
 def get_gspread_client():
     try:
-        scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
-        # Convert streamlit secrets to dict format expected by gspread
-        creds_dict = {
-            "type": st.secrets["connections"]["gsheets"]["type"],
-            "project_id": st.secrets["connections"]["gsheets"]["project_id"],
-            "private_key_id": st.secrets["connections"]["gsheets"]["private_key_id"],
-            "private_key": st.secrets["connections"]["gsheets"]["private_key"].replace("\\n", "\n"),
-            "client_email": st.secrets["connections"]["gsheets"]["client_email"],
-            "client_id": st.secrets["connections"]["gsheets"]["client_id"],
-            "auth_uri": st.secrets["connections"]["gsheets"]["auth_uri"],
-            "token_uri": st.secrets["connections"]["gsheets"]["token_uri"],
-            "auth_provider_x509_cert_url": st.secrets["connections"]["gsheets"]["auth_provider_x509_cert_url"],
-            "client_x509_cert_url": st.secrets["connections"]["gsheets"]["client_x509_cert_url"]
-        }
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-        return gspread.authorize(creds)
+        return _authorize()
     except Exception as e:
         st.error(f"Failed to authorize Google Sheets: {e}")
         return None
@@ -58,22 +67,151 @@ def get_worksheet():
         st.error(f"Failed to open spreadsheet: {e}")
         return None
 
+def _open_worksheet():
+    # Used by the background flusher: raises instead of reporting through st.error.
+    url = st.secrets["connections"]["gsheets"]["spreadsheet"]
+    return _authorize().open_by_url(url).get_worksheet(0)
+
+# --- Write Journal ---
+@st.cache_resource
+def get_journal():
+    journal = WriteJournal()
+    journal.start_flusher(_open_worksheet)
+    return journal
+
+def get_sync_status():
+    """Journaled writes not yet on the sheet, and the last flush error (if any)."""
+    journal = get_journal()
+    return journal.pending(), journal.last_error
+
+def _format_time(t):
+    return '' if pd.isna(t) else pd.Timestamp(t).strftime('%Y-%m-%d %H:%M:%S')
+
+def _row_values(r):
+    return [r['User'], r['GPU_ID'], r['GPU_Type'], _format_time(r['Start']), _format_time(r['End']), r['Project']]
+
+def _row_ids(df):
+    """Content-derived row IDs: the row's values plus an occurrence number for exact duplicates.
+
+    Unlike sheet positions they don't shift when other rows are added or deleted,
+    and an ID only resolves to a row with exactly the values the user saw.
+    """
+    keys = pd.Series(["|".join(str(v).strip() for v in _row_values(r)) for _, r in df.iterrows()], index=df.index, dtype=object)
+    return keys + "#" + keys.groupby(keys).cumcount().astype(str)
+
+def _apply_pending(df, pending):
+    """Overlay journaled writes that have not reached the sheet yet.
+
+    Matching is by row content only; load_reservations assigns row IDs afterwards.
+    """
+    if not pending:
+        return df
+    added = []
+    dropped = set()
+    sheet_keys = None
+    for e in pending:
+        if e['op'] == 'add':
+            added.append(e['row'])
+            continue
+        key = normalize_row(e['row'])
+        match = next((i for i, row in enumerate(added) if normalize_row(row) == key), None)
+        if match is not None:
+            del added[match]
+            continue
+        if sheet_keys is None:
+            sheet_keys = [normalize_row(_row_values(r)) for _, r in df.iterrows()]
+        match = next((i for i, k in enumerate(sheet_keys) if i not in dropped and k == key), None)
+        if match is not None:
+            dropped.add(match)
+
+    df = df.drop(index=df.index[sorted(dropped)])
+    if added:
+        new = pd.DataFrame(added, columns=COLUMNS)
+        new['Start'] = pd.to_datetime(new['Start'])
+        new['End'] = pd.to_datetime(new['End'])
+        df = new if df.empty else pd.concat([df, new], ignore_index=True)
+    return df
+
 def load_reservations():
+    # Snapshot pending writes before reading the sheet: an entry flushed in between
+    # shows twice for one render instead of going missing from conflict checks.
+    pending = get_journal().pending()
+    df = _apply_pending(_load_sheet(), pending)
+    if not df.empty:
+        df.index = pd.Index(_row_ids(df), name="ID")
+    return df
+
+def _records_frame(data):
+    df = pd.DataFrame(data)
+    if df.empty:
+        return pd.DataFrame(columns=COLUMNS)
+    df['Start'] = pd.to_datetime(df['Start']).dt.tz_localize(None)
+    df['End'] = pd.to_datetime(df['End']).dt.tz_localize(None)
+    return df
+
+def _load_sheet():
     ws = get_worksheet()
     if ws is None:
-        return pd.DataFrame(columns=["User", "GPU_ID", "GPU_Type", "Start", "End", "Project"])
+        return pd.DataFrame(columns=COLUMNS)
     try:
-        data = ws.get_all_records()
-        df = pd.DataFrame(data)
-        if not df.empty:
-            df['Start'] = pd.to_datetime(df['Start']).dt.tz_localize(None)
-            df['End'] = pd.to_datetime(df['End']).dt.tz_localize(None)
-        else:
-            df = pd.DataFrame(columns=["User", "GPU_ID", "GPU_Type", "Start", "End", "Project"])
-        return df
+        return _records_frame(ws.get_all_records())
     except Exception as e:
         st.error(f"Error loading data: {e}")
-        return pd.DataFrame(columns=["User", "GPU_ID", "GPU_Type", "Start", "End", "Project"])
+        return pd.DataFrame(columns=COLUMNS)
+
+def _read_sheet():
+    # Like _load_sheet, but raises instead of returning an empty frame on errors.
+    return _records_frame(_open_worksheet().get_all_records())
+
+# Short-lived snapshot for views that rerun often (paging, sorting, selecting).
+# Writes clear it so the next render sees the change.
+@st.cache_data(ttl=60, show_spinner=False)
+def load_reservations_cached():
+    return load_reservations()
+
+def query_reservations(df=None, user=None, gpu_id=None, date_from=None, date_to=None,
+                       upcoming_only=False, now=None, after=None, page_size=25):
+    """Filter and page reservations, newest Start first.
+
+    Row IDs are the content-derived DataFrame index from load_reservations, so
+    they stay stable across sorting, paging and reloads. `after` is the
+    (Start, ID) cursor of the last row of the previous page.
+    Returns (page_df, next_cursor, total_matches).
+    """
+    if df is None:
+        df = load_reservations_cached()
+    if df.empty:
+        return df, None, 0
+
+    mask = pd.Series(True, index=df.index)
+    if user:
+        mask &= df['User'] == user
+    if gpu_id:
+        mask &= df['GPU_ID'] == gpu_id
+    if date_from is not None:
+        mask &= df['End'] > pd.Timestamp(date_from)
+    if date_to is not None:
+        mask &= df['Start'] < pd.Timestamp(date_to) + pd.Timedelta(days=1)
+    if upcoming_only:
+        now = pd.Timestamp(now if now is not None else datetime.now()).tz_localize(None)
+        mask &= df['End'] > now
+    total = int(mask.sum())
+
+    if after is not None:
+        after_start, after_id = pd.Timestamp(after[0]), after[1]
+        mask &= (df['Start'] < after_start) | ((df['Start'] == after_start) & (df.index < after_id))
+
+    # Sort only the keys; full rows are materialized for the visible page alone.
+    keys = pd.DataFrame({'Start': df.loc[mask, 'Start'].to_numpy(), 'ID': df.index[mask]})
+    keys = keys.sort_values(by=['Start', 'ID'], ascending=False).head(page_size + 1)
+    page_ids = keys['ID'].iloc[:page_size].tolist()
+    page = df.loc[page_ids]
+
+    next_cursor = None
+    if len(keys) > page_size:
+        last = keys.iloc[page_size - 1]
+        next_cursor = (last['Start'], last['ID'])
+    return page, next_cursor, total
 
 def check_conflicts(gpu_id, start_time, end_time, df=None):
     if df is None:
@@ -101,41 +239,135 @@ def add_reservation(user, gpu_id, start_time, end_time, project, force=False):
         project
     ]
     
+    # Acknowledged once journaled; the background flusher pushes it to the sheet.
+    journal = get_journal()
+    try:
+        with _rollups_lock:
+            rec = journal.append('add', row)
+            _record_delta(rec['seq'], 'add', dict(zip(COLUMNS, row)))
+    except OSError as e:
+        return False, f"Error saving reservation: {e}"
+    load_reservations_cached.clear()
+    return True, "Reservation successful! Syncing to Google Sheets."
+
+def delete_reservations(rows):
+    """Queue deletion of the given reservations (rows of a load_reservations frame).
+
+    Callers pick rows by their content IDs, and the flusher matches them on the
+    sheet by content too, so shifting row numbers never select another booking.
+    """
+    journal = get_journal()
+    try:
+        with _rollups_lock:
+            for _, r in rows.iterrows():
+                rec = journal.append('delete', _row_values(r))
+                _record_delta(rec['seq'], 'remove', r)
+    except OSError as e:
+        return False, f"Error deleting: {e}"
+    load_reservations_cached.clear()
+    return True, "Selected reservations deleted."
+
+# --- Occupancy Rollups ---
+# Built once from the full history, then kept current by per-write deltas.
+# Periodic rebuilds pick up edits made directly in the sheet.
+ROLLUP_REBUILD_SECONDS = 15 * 60
+ROLLUP_FLUSH_WAIT_SECONDS = 5
+_rollups = None
+# (journal seq, 'add'/'remove', row) applied since the last build. A build only
+# includes entries up to its snapshot seq, so later deltas are replayed onto it.
+_rollup_deltas = []
+_rollups_lock = threading.Lock()
+
+def _build_rollups(timeout=-1):
+    """Rollups from a fresh read of the sheet and journal, and the last journal seq they include.
+
+    Flushing is paused for the snapshot and read, so no entry is both on the
+    sheet and pending. Raises if the sheet can't be read, or FlushInProgress if
+    a flush doesn't finish within `timeout` seconds.
+    """
+    journal = get_journal()
+    with journal.paused(timeout):
+        pending, seq, unconfirmed = journal.snapshot()
+        df = _read_sheet()
+    return OccupancyRollups.from_frame(_apply_pending(df, _unlanded(df, pending, unconfirmed))), seq
+
+def _unlanded(df, pending, unconfirmed):
+    """Drop unconfirmed adds an earlier failed flush already put on the sheet.
+
+    Uses the same content match the flusher does before re-appending, so only
+    rows it would skip are dropped; identical forced bookings still count.
+    """
+    if not unconfirmed:
+        return pending
+    sheet_rows = [normalize_row(_row_values(r)) for _, r in df.iterrows()]
+    taken = set()
+    return [
+        e for e in pending
+        if not (e['op'] == 'add' and e['seq'] in unconfirmed and find_row(sheet_rows, e['row'], taken) is not None)
+    ]
+
+def _catch_up(rollups, seq):
+    # Caller holds _rollups_lock.
+    for delta_seq, op, r in _rollup_deltas:
+        if delta_seq > seq:
+            (rollups.add if op == 'add' else rollups.remove)(r)
+
+def _install(rollups, seq):
+    # Caller holds _rollups_lock; `rollups` must already be caught up past `seq`.
+    global _rollups, _rollup_deltas
+    _rollups = rollups
+    _rollup_deltas = [d for d in _rollup_deltas if d[0] > seq]
+
+def _record_delta(seq, op, r):
+    # Caller holds _rollups_lock, taken before the journal append so seq order matches.
+    _rollup_deltas.append((seq, op, r))
+    if _rollups is not None:
+        (_rollups.add if op == 'add' else _rollups.remove)(r)
+
+def get_rollups():
+    current = _rollups
+    if current is not None and time.time() - current.built_at <= ROLLUP_REBUILD_SECONDS:
+        return current
+    # Read outside the lock so writes don't wait on the network.
     try:
-        ws = get_worksheet()
-        if ws:
-            ws.append_row(row)
-            return True, "Reservation successful!"
-        return False, "Could not access sheet for writing."
+        # A first build has to wait for any in-flight flush; a refresh can try again next render.
+        fresh, seq = _build_rollups(timeout=-1 if current is None else ROLLUP_FLUSH_WAIT_SECONDS)
+    except FlushInProgress:
+        return current
     except Exception as e:
-        return False, f"Error saving to Sheet: {e}"
+        st.error(f"Error refreshing occupancy data: {e}")
+        # Keep serving the last good rollups; never cache a failed load.
+        return current if current is not None else OccupancyRollups()
+    with _rollups_lock:
+        _catch_up(fresh, seq)
+        _install(fresh, seq)
+        return _rollups
+
+def verify_rollups(rebuild=False):
+    """Compare the rollups with a full recomputation; optionally rebuild on drift.
 
-def delete_reservations(indices):
+    Returns the mismatching cells (empty DataFrame when consistent), or None if
+    the sheet could not be read.
+    """
+    current = get_rollups()
     try:
-        ws = get_worksheet()
-        if not ws: return False, "Could not access sheet."
-        
-        # indices are 0-based from dataframe, gspread rows are 1-based (and header is row 1)
-        # So row to delete is index + 2
-        # Delete in reverse to avoid index shifting
-        for idx in sorted(indices, reverse=True):
-            ws.delete_rows(idx + 2)
-        return True, "Selected reservations deleted."
+        fresh, seq = _build_rollups()
     except Exception as e:
-        return False, f"Error deleting: {e}"
+        st.error(f"Error loading data: {e}")
+        return None
+    with _rollups_lock:
+        _catch_up(fresh, seq)
+        mismatches = compare_rollups(_rollups if _rollups is not None else current, fresh)
+        if rebuild and not mismatches.empty:
+            _install(fresh, seq)
+    return mismatches
 
 def get_occupancy_stats(target_date):
-    df = load_reservations()
-    if df.empty: return {"RTX 4090": 0.0, "H100": 0.0}
-    
-    day_start = pd.to_datetime(target_date).replace(hour=0, minute=0, second=0).tz_localize(None)
-    day_end = day_start + pd.Timedelta(days=1)
-    
-    todays_res = df[(df['Start'] < day_end) & (df['End'] > day_start)]
-    if todays_res.empty: return {"RTX 4090": 0.0, "H100": 0.0}
+    active = get_rollups().active_gpus(target_date)
+    if not active: return {"RTX 4090": 0.0, "H100": 0.0}
 
-    rtx_count = todays_res[todays_res['GPU_Type'] == 'RTX 4090']['GPU_ID'].nunique()
-    h100_count = todays_res[todays_res['GPU_Type'] == 'H100']['GPU_ID'].nunique()
+    rtx_count = sum(1 for g in GPUS if g['type'] == 'RTX 4090' and g['id'] in active)
+    h100_count = sum(1 for g in GPUS if g['type'] == 'H100' and g['id'] in active)
     
     return {
         "RTX 4090": (rtx_count / 4.0) * 100,
@@ -0,0 +1,143 @@
+import threading
+import time
+from collections import Counter
+
+import pandas as pd
+
+HOUR = pd.Timedelta(hours=1)
+DAY = pd.Timedelta(days=1)
+
+# Rollup tables: bucket start -> {GPU_ID or User: [reserved seconds, reservation count]}
+TABLES = ("hourly_gpu", "hourly_user", "daily_gpu", "daily_user")
+
+
+def _buckets(start, end, step):
+    """Yield (bucket_start, overlap_seconds) for each bucket overlapping [start, end)."""
+    if step == DAY:
+        b = start.normalize()
+    else:
+        b = start.replace(minute=0, second=0, microsecond=0, nanosecond=0)
+    while b < end:
+        overlap = min(end, b + step) - max(start, b)
+        yield b, int(overlap.total_seconds())
+        b += step
+
+
+def _reservation_key(r):
+    return (str(r['User']), str(r['GPU_ID']), pd.Timestamp(r['Start']), pd.Timestamp(r['End']), str(r['Project']))
+
+
+class OccupancyRollups:
+    """Hourly and daily reserved time per GPU and per user.
+
+    Each add/remove touches only the buckets the reservation overlaps, so
+    long-range views never rescan the reservation list.
+    """
+
+    def __init__(self):
+        self.tables = {name: {} for name in TABLES}
+        self.built_at = time.time()
+        self._rows = Counter()
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_frame(cls, df):
+        rollups = cls()
+        for _, r in df.iterrows():
+            rollups.add(r)
+        return rollups
+
+    # --- Incremental maintenance ---
+    def add(self, r):
+        if pd.isna(r['Start']) or pd.isna(r['End']):
+            return False
+        with self._lock:
+            self._rows[_reservation_key(r)] += 1
+            self._apply(r, 1)
+        return True
+
+    def remove(self, r):
+        """Remove a reservation; returns False if it was never counted."""
+        if pd.isna(r['Start']) or pd.isna(r['End']):
+            return False
+        key = _reservation_key(r)
+        with self._lock:
+            if self._rows[key] == 0:
+                return False
+            self._rows[key] -= 1
+            if self._rows[key] == 0:
+                del self._rows[key]
+            self._apply(r, -1)
+        return True
+
+    def _apply(self, r, sign):
+        user, gpu_id = str(r['User']), str(r['GPU_ID'])
+        start, end = pd.Timestamp(r['Start']), pd.Timestamp(r['End'])
+        for hour, secs in _buckets(start, end, HOUR):
+            self._bump("hourly_gpu", hour, gpu_id, secs, sign)
+            self._bump("hourly_user", hour, user, secs, sign)
+        for day, secs in _buckets(start, end, DAY):
+            self._bump("daily_gpu", day, gpu_id, secs, sign)
+            self._bump("daily_user", day, user, secs, sign)
+
+    def _bump(self, table, bucket, key, secs, sign):
+        cells = self.tables[table].setdefault(bucket, {})
+        cell = cells.setdefault(key, [0, 0])
+        cell[0] += secs * sign
+        cell[1] += sign
+        if cell[1] == 0:
+            del cells[key]
+            if not cells:
+                del self.tables[table][bucket]
+
+    # --- Reads ---
+    def day(self, date):
+        """(number of reservations overlapping the day, users with a reservation that day)."""
+        day = pd.Timestamp(date).normalize()
+        with self._lock:
+            gpus = self.tables["daily_gpu"].get(day, {})
+            users = self.tables["daily_user"].get(day, {})
+            return sum(c[1] for c in gpus.values()), sorted(users)
+
+    def active_gpus(self, date):
+        day = pd.Timestamp(date).normalize()
+        with self._lock:
+            return set(self.tables["daily_gpu"].get(day, {}))
+
+    def frame(self, table, start=None, end=None):
+        """Table rows with bucket in [start, end) as a DataFrame (Bucket, Key, Hours, Count)."""
+        start = pd.Timestamp(start) if start is not None else None
+        end = pd.Timestamp(end) if end is not None else None
+        with self._lock:
+            rows = [
+                (bucket, key, cell[0] / 3600.0, cell[1])
+                for bucket, cells in self.tables[table].items()
+                if (start is None or bucket >= start) and (end is None or bucket < end)
+                for key, cell in cells.items()
+            ]
+        frame = pd.DataFrame(rows, columns=["Bucket", "Key", "Hours", "Count"])
+        frame['Bucket'] = pd.to_datetime(frame['Bucket'])  # keep .dt usable on empty frames
+        return frame
+
+
+def compare_rollups(rollups, expected):
+    """Cells where `rollups` differs from `expected`, as a DataFrame (empty when equal)."""
+    mismatches = []
+    with rollups._lock, expected._lock:
+        for table in TABLES:
+            ours, theirs = rollups.tables[table], expected.tables[table]
+            for bucket in set(ours) | set(theirs):
+                a, b = ours.get(bucket, {}), theirs.get(bucket, {})
+                for key in set(a) | set(b):
+                    if a.get(key) != b.get(key):
+                        mismatches.append((table, bucket, key, a.get(key), b.get(key)))
+    mismatches = pd.DataFrame(mismatches, columns=["Table", "Bucket", "Key", "Rollup", "Recomputed"])
+    return mismatches.sort_values(by=["Table", "Bucket", "Key"]).reset_index(drop=True)
+
+
+def check_consistency(rollups, df):
+    """Compare maintained rollups with a full recomputation from `df`.
+
+    Returns a DataFrame of mismatching cells (empty when consistent).
+    """
+    return compare_rollups(rollups, OccupancyRollups.from_frame(df))
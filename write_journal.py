@@ -0,0 +1,313 @@
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+from gspread.exceptions import APIError
+
+# --- Journal Settings ---
+JOURNAL_PATH = os.environ.get(
+    "GPU_JOURNAL_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "write_journal.jsonl")
+)
+MAX_REQUESTS_PER_MINUTE = 50   # Sheets allows 60/min per user; keep headroom for reads
+BATCH_SIZE = 200               # journal entries coalesced into one flush
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0             # seconds
+BACKOFF_MAX = 64.0
+FLUSH_INTERVAL = 5.0
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+# Sheet column order written by add_reservation: User, GPU_ID, GPU_Type, Start, End, Project
+DATE_COLUMNS = (3, 4)
+
+
+class FlushInProgress(Exception):
+    """Raised by WriteJournal.paused when an in-flight flush outlasts the timeout."""
+
+
+def normalize_row(values):
+    """Comparable form of a reservation row (sheet cells or journal entry)."""
+    row = [str(v).strip() for v in list(values)[:6]]
+    for i in DATE_COLUMNS:
+        if i < len(row):
+            try:
+                row[i] = pd.to_datetime(row[i]).strftime('%Y-%m-%d %H:%M:%S')
+            except (ValueError, TypeError):
+                pass
+    return row
+
+
+def coalesce(entries, unconfirmed=()):
+    """Collapse journal entries into one delete set and one append set.
+
+    An add that is deleted again before it reaches the sheet cancels out. If the
+    add may already be on the sheet (seq in `unconfirmed`), the delete is still sent.
+    Returns (rows_to_append, rows_to_delete, add_seqs, other_seqs).
+    """
+    adds = []
+    deletes = []
+    other_seqs = []
+    for e in entries:
+        if e['op'] == 'delete':
+            key = normalize_row(e['row'])
+            match = next((i for i, a in enumerate(adds) if normalize_row(a['row']) == key), None)
+            if match is not None:
+                add = adds.pop(match)
+                other_seqs.append(add['seq'])
+                if add['seq'] in unconfirmed:
+                    deletes.append(e['row'])
+            else:
+                deletes.append(e['row'])
+            other_seqs.append(e['seq'])
+        else:
+            adds.append(e)
+    return [a['row'] for a in adds], deletes, [a['seq'] for a in adds], other_seqs
+
+
+def find_row(sheet_rows, row, taken):
+    """Index of the first sheet row equal to `row` not already in `taken` (and mark it)."""
+    key = normalize_row(row)
+    for i, sheet_row in enumerate(sheet_rows):
+        if i not in taken and sheet_row == key:
+            taken.add(i)
+            return i
+    return None
+
+
+class RateLimiter:
+    """Spaces out calls so at most `per_minute` are issued per minute."""
+
+    def __init__(self, per_minute):
+        self.interval = 60.0 / per_minute
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class WriteJournal:
+    """Append-only local log of sheet writes, flushed to Google Sheets in the background.
+
+    Each write is fsynced before it is acknowledged to the caller. Entries stay
+    pending until the sheet confirms them, and are replayed after a restart.
+    Adds that may already have reached the sheet (replayed after a restart, or
+    whose flush failed midway) are checked against the sheet before being
+    appended again, so replays don't create duplicate bookings.
+    """
+
+    def __init__(self, path=JOURNAL_PATH, per_minute=MAX_REQUESTS_PER_MINUTE):
+        self.path = path
+        self.limiter = RateLimiter(per_minute)
+        self.last_error = None
+        self._pending = []
+        self._next_seq = 1
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._ws = None
+        self._unconfirmed = set()  # add seqs that may already be on the sheet
+        self._replay()
+
+    # --- Local log ---
+    def _replay(self):
+        if not os.path.exists(self.path):
+            return
+        entries = {}
+        acked = set()
+        torn = False
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    torn = True  # crash mid-write; the next append would run into it
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    torn = True
+                    continue
+                if rec['op'] == 'ack':
+                    acked.update(rec['seqs'])
+                else:
+                    entries[rec['seq']] = rec
+                    self._next_seq = max(self._next_seq, rec['seq'] + 1)
+        self._pending = [e for seq, e in sorted(entries.items()) if seq not in acked]
+        self._unconfirmed = {e['seq'] for e in self._pending if e['op'] == 'add'}
+        if torn:
+            # Rewrite with only the valid, unacknowledged records before accepting appends.
+            self._rewrite(self._pending)
+
+    def _write(self, records, mode='a'):
+        with open(self.path, mode, encoding='utf-8') as f:
+            for rec in records:
+                f.write(json.dumps(rec, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _rewrite(self, records):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for rec in records:
+                f.write(json.dumps(rec, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def append(self, op, row):
+        """Durably record a write ('add' or 'delete'). Raises OSError if it cannot be journaled."""
+        with self._lock:
+            rec = {'seq': self._next_seq, 'op': op, 'row': [str(v) for v in row], 'ts': time.time()}
+            self._write([rec])
+            self._next_seq += 1
+            self._pending.append(rec)
+        self._wake.set()
+        return rec
+
+    def pending(self):
+        with self._lock:
+            return list(self._pending)
+
+    def snapshot(self):
+        """(pending entries, seq of the last entry journaled so far, seqs of adds that
+        may already be on the sheet), taken atomically."""
+        with self._lock:
+            return list(self._pending), self._next_seq - 1, set(self._unconfirmed)
+
+    @contextmanager
+    def paused(self, timeout=-1):
+        """Hold off flushing so snapshot() and a sheet read see the same state.
+
+        Waits for an in-flight flush; raises FlushInProgress if it doesn't finish in
+        `timeout` seconds. The flusher skips its round while paused.
+        """
+        if not self._flush_lock.acquire(timeout=timeout):
+            raise FlushInProgress("a flush to Google Sheets is in progress")
+        try:
+            yield
+        finally:
+            self._flush_lock.release()
+
+    def _ack(self, seqs):
+        if not seqs:
+            return
+        seqs = set(seqs)
+        with self._lock:
+            self._pending = [e for e in self._pending if e['seq'] not in seqs]
+            self._unconfirmed -= seqs
+            if self._pending:
+                self._write([{'op': 'ack', 'seqs': sorted(seqs)}])
+            else:
+                # Everything is on the sheet; start the log over.
+                self._write([], mode='w')
+
+    # --- Remote flush ---
+    def _call(self, fn, *args, **kwargs):
+        for attempt in range(MAX_RETRIES + 1):
+            self.limiter.wait()
+            try:
+                return fn(*args, **kwargs)
+            except (APIError, OSError) as e:
+                status = getattr(getattr(e, 'response', None), 'status_code', None)
+                retryable = isinstance(e, OSError) or status in RETRYABLE_STATUS
+                if not retryable or attempt == MAX_RETRIES:
+                    raise
+                time.sleep(min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) + random.uniform(0, 1))
+
+    def flush(self, open_worksheet):
+        """Push pending entries to the sheet in coalesced batches. Returns entries flushed."""
+        if not self._flush_lock.acquire(blocking=False):
+            return 0
+        flushed = 0
+        try:
+            while True:
+                batch = self.pending()[:BATCH_SIZE]
+                if not batch:
+                    return flushed
+                rows_to_append, rows_to_delete, add_seqs, other_seqs = coalesce(batch, self._unconfirmed)
+                unsure = {i for i, seq in enumerate(add_seqs) if seq in self._unconfirmed}
+
+                if self._ws is None:
+                    self._ws = self._call(open_worksheet)
+                ws = self._ws
+                try:
+                    sheet_rows = None
+                    taken = set()
+                    if rows_to_delete or unsure:
+                        values = self._call(ws.get_all_values)
+                        sheet_rows = [normalize_row(v) for v in values[1:]]  # row 1 is the header
+                    if rows_to_delete:
+                        self._delete_rows(ws, sheet_rows, rows_to_delete, taken)
+                    self._ack(other_seqs)
+                    if unsure:
+                        # Skip adds an earlier, unacknowledged flush already appended.
+                        rows_to_append = [
+                            row for i, row in enumerate(rows_to_append)
+                            if i not in unsure or find_row(sheet_rows, row, taken) is None
+                        ]
+                    if rows_to_append:
+                        # From here on the outcome is uncertain until the ack is written.
+                        self._unconfirmed.update(add_seqs)
+                        self._call(ws.append_rows, rows_to_append)
+                    self._ack(add_seqs)
+                except Exception:
+                    self._ws = None  # reopen on the next attempt
+                    raise
+                flushed += len(batch)
+        finally:
+            self._flush_lock.release()
+
+    def _delete_rows(self, ws, sheet_rows, rows, taken):
+        matched = [i for i in (find_row(sheet_rows, row, taken) for row in rows) if i is not None]
+        # Rows no longer on the sheet were already removed; nothing to do.
+        if not matched:
+            return
+        # One batchUpdate for all deletions, bottom-up so row numbers don't shift.
+        requests = [
+            {"deleteDimension": {"range": {
+                "sheetId": ws.id, "dimension": "ROWS",
+                "startIndex": i + 1, "endIndex": i + 2
+            }}}
+            for i in sorted(matched, reverse=True)
+        ]
+        self._call(ws.spreadsheet.batch_update, {"requests": requests})
+
+    # --- Background flusher ---
+    def start_flusher(self, open_worksheet, interval=FLUSH_INTERVAL):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._run, args=(open_worksheet, interval),
+                name="sheet-write-journal", daemon=True
+            )
+            self._thread.start()
+        if self._pending:
+            self._wake.set()
+
+    def _run(self, open_worksheet, interval):
+        delay = interval
+        while True:
+            if self.last_error:
+                time.sleep(delay)  # backing off; new writes don't cut it short
+            else:
+                self._wake.wait(delay)
+            self._wake.clear()
+            try:
+                self.flush(open_worksheet)
+                self.last_error = None
+                delay = interval
+            except Exception as e:
+                self.last_error = str(e)
+                delay = min(BACKOFF_MAX, delay * 2)